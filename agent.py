@@ -1,7 +1,14 @@
 import os
+import re
+import asyncio
 import duckdb
 import json
+import functools
+import threading
+import contextlib
+from collections import OrderedDict
 from dotenv import load_dotenv
+from duckdb import ColumnExpression, ConstantExpression, FunctionExpression
 
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
@@ -13,6 +20,259 @@ if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY not found in .env file")
 
 DB_FILE = 'samarth.db'
+CACHE_VERSION_FILE = 'CACHE_VERSION'
+RESPONSE_CACHE_SIZE = 512
+DUCKDB_THREADS = os.cpu_count() or 1
+DUCKDB_MEMORY_LIMIT = '2GB'
+
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    Returns the process-wide event loop, running on a daemon thread. The 
+    shared ChatOpenAI client pools connections on the loop that first used 
+    it, so every agent run must go through this same loop.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name="samarth-event-loop", daemon=True).start()
+        return _event_loop
+
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop and waits for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+def iter_async(async_gen):
+    """Iterates an async generator on the shared event loop from synchronous code."""
+    loop = get_event_loop()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(async_gen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def _read_cache_version():
+    try:
+        with open(CACHE_VERSION_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def get_connection():
+    """Returns the process-wide read-only DuckDB connection."""
+    global _cache_version
+    _cache_version = _read_cache_version()
+    con = duckdb.connect(database=DB_FILE, read_only=True)
+    con.execute("PRAGMA enable_object_cache")
+    con.execute(f"PRAGMA threads={DUCKDB_THREADS}")
+    con.execute(f"PRAGMA memory_limit='{DUCKDB_MEMORY_LIMIT}'")
+    return con
+
+
+def warm_connection():
+    """
+    Touches the tables the tools read so the first question doesn't pay cold 
+    reads. Warming is only an optimization, so a missing or outdated database 
+    is reported and otherwise ignored; the tools surface the error per call.
+    """
+    try:
+        con = get_connection()
+    except duckdb.Error as e:
+        print(f"Skipping warm-up, could not open {DB_FILE}: {e}. Run et1.py first.")
+        return
+    for query in [
+        "SELECT MIN(year), MAX(year), SUM(total_production), COUNT(DISTINCT state_norm), "
+        "COUNT(DISTINCT crop_norm), MAX(LENGTH(crop)), MAX(LENGTH(source_url)) FROM agri_state_year_crop",
+        "SELECT MIN(year), MAX(year), SUM(total_annual_rainfall), COUNT(DISTINCT subdivision_norm), "
+        "MAX(LENGTH(subdivision)), MAX(LENGTH(source_url)) FROM climate_subdivision_year",
+        "SELECT COUNT(DISTINCT state_norm), COUNT(DISTINCT subdivision_norm), SUM(weight) FROM state_subdivision_map",
+        "SELECT COUNT(DISTINCT alias_norm), COUNT(DISTINCT subdivision_norm) FROM subdivision_alias"
+    ]:
+        try:
+            con.execute(query).fetchall()
+        except duckdb.Error as e:
+            print(f"Skipping warm-up query: {e}. Re-run et1.py to rebuild {DB_FILE}.")
+
+
+_cache_version = None
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+_cursors_in_use = 0
+_cursors_idle = threading.Condition()
+
+
+@contextlib.contextmanager
+def _cursor():
+    """Yields a cursor on the shared connection, tracked so a reload can wait for it."""
+    global _cursors_in_use
+    with _cursors_idle:
+        _cursors_in_use += 1
+    try:
+        with get_connection().cursor() as cur:
+            yield cur
+    finally:
+        with _cursors_idle:
+            _cursors_in_use -= 1
+            _cursors_idle.notify_all()
+
+
+def _check_cache_version():
+    """
+    Reopens the connection and clears the result caches if the ETL has 
+    swapped in a new database file since the connection was opened.
+    """
+    global _cache_version
+    if _read_cache_version() == _cache_version:
+        return
+    with _cursors_idle:
+        # DuckDB shares one database instance per path while any handle is 
+        # open, so the old connection must be fully closed before reopening.
+        _cursors_idle.wait_for(lambda: _cursors_in_use == 0)
+        if _read_cache_version() == _cache_version:
+            return
+        if get_connection.cache_info().currsize:
+            get_connection().close()
+            get_connection.cache_clear()
+        _top_crops.cache_clear()
+        _average_rainfall.cache_clear()
+        _crop_climate_trends.cache_clear()
+        with _response_cache_lock:
+            _response_cache.clear()
+        _cache_version = _read_cache_version()
+
+
+def _fetch_records(rel):
+    """Returns the rows of a DuckDB relation as a list of dicts."""
+    return [dict(zip(rel.columns, row)) for row in rel.fetchall()]
+
+
+def _matches(column, value):
+    """Equality against a column's lowercase *_norm copy; value is already normalized."""
+    return ColumnExpression(f"{column}_norm") == ConstantExpression(value)
+
+
+def _year_between(start_year, end_year):
+    return ColumnExpression("year").between(ConstantExpression(start_year), ConstantExpression(end_year))
+
+
+# The tool helpers take the data version as their first argument purely so it 
+# is part of the cache key: a result computed across an ETL reload is stored 
+# under the old version and is never served for the new data.
+@functools.lru_cache(maxsize=512)
+def _top_crops(version, state, year, top_m):
+    with _cursor() as cur:
+        rel = (
+            cur.table("agri_state_year_crop")
+            .filter(_matches("state", state) & (ColumnExpression("year") == ConstantExpression(year)))
+            .select(
+                ColumnExpression("crop"),
+                ColumnExpression("total_production").cast(duckdb.type("INTEGER")).alias("total_production"),
+                ColumnExpression("source_url")
+            )
+            .sort(ColumnExpression("total_production").desc())
+            .limit(top_m)
+        )
+        result = _fetch_records(rel)
+    if not result:
+        return None
+    return json.dumps(result, default=str)
+
+
+@functools.lru_cache(maxsize=512)
+def _average_rainfall(version, subdivision, start_year, end_year):
+    with _cursor() as cur:
+        aliases = (
+            cur.table("subdivision_alias")
+            .filter(ColumnExpression("alias_norm") == ConstantExpression(subdivision))
+            .select(ColumnExpression("subdivision_norm"))
+            .fetchall()
+        )
+        names = [subdivision] + [name for (name,) in aliases]
+        rel = (
+            cur.table("climate_subdivision_year")
+            .filter(
+                ColumnExpression("subdivision_norm").isin(*[ConstantExpression(name) for name in names])
+                & _year_between(start_year, end_year)
+            )
+            .aggregate([
+                FunctionExpression("avg", ColumnExpression("total_annual_rainfall")).alias("average_annual_rainfall"),
+                FunctionExpression("any_value", ColumnExpression("source_url")).alias("source_url")
+            ])
+        )
+        result = _fetch_records(rel)
+    return json.dumps(result, default=str)
+
+
+@functools.lru_cache(maxsize=512)
+def _crop_climate_trends(version, crop_name, state, start_year, end_year):
+    with _cursor() as cur:
+        crop_rel = (
+            cur.table("agri_state_year_crop")
+            .filter(_matches("state", state) & _matches("crop", crop_name) & _year_between(start_year, end_year))
+            .select(
+                ConstantExpression("crop").alias("series"),
+                ColumnExpression("year"),
+                ColumnExpression("total_production").alias("value"),
+                ColumnExpression("source_url"),
+                ConstantExpression(None).cast(duckdb.type("VARCHAR")).alias("subdivisions")
+            )
+        )
+        rain_rel = (
+            cur.table("climate_subdivision_year")
+            .join(cur.table("state_subdivision_map"), "subdivision_norm")
+            .filter((ColumnExpression("state_norm") == ConstantExpression(state)) & _year_between(start_year, end_year))
+            .aggregate([
+                ColumnExpression("year"),
+                (
+                    FunctionExpression("sum", ColumnExpression("total_annual_rainfall") * ColumnExpression("weight"))
+                    / FunctionExpression("sum", ColumnExpression("weight"))
+                ).alias("value"),
+                FunctionExpression("any_value", ColumnExpression("source_url")).alias("source_url"),
+                FunctionExpression(
+                    "array_to_string",
+                    FunctionExpression("list_sort", FunctionExpression("list", ColumnExpression("subdivision"))),
+                    ConstantExpression(", ")
+                ).alias("subdivisions")
+            ], "year")
+            .select(
+                ConstantExpression("rain").alias("series"),
+                ColumnExpression("year"),
+                ColumnExpression("value"),
+                ColumnExpression("source_url"),
+                ColumnExpression("subdivisions")
+            )
+        )
+        rows = (
+            crop_rel.union(rain_rel)
+            .sort(ColumnExpression("series"), ColumnExpression("year"))
+            .fetchall()
+        )
+    
+    correlation_data = {
+        "crop_production_trend": [
+            {"year": year, "total_production": value, "source_url": source_url}
+            for series, year, value, source_url, _ in rows if series == "crop"
+        ],
+        "rainfall_trend": [
+            {"year": year, "total_annual_rainfall": value, "subdivisions": subdivisions, "source_url": source_url}
+            for series, year, value, source_url, subdivisions in rows if series == "rain"
+        ]
+    }
+    return json.dumps(correlation_data, indent=2, default=str)
+
+
+def _normalize(name):
+    return name.strip().lower()
 
 
 @tool
@@ -23,25 +283,13 @@ def get_top_crops_by_production(state: str, year: int, top_m: int) -> str:
     """
     print(f"Tool called: get_top_crops_by_production(state={state}, year={year}, top_m={top_m})")
     try:
-        con = duckdb.connect(database=DB_FILE, read_only=True)
-        query = f"""
-        SELECT 
-            crop, 
-            CAST(SUM(CAST(production_tonnes AS DOUBLE)) AS INTEGER) AS total_production,
-            ANY_VALUE(source_url) AS source_url
-        FROM agriculture_production
-        WHERE state ILIKE '{state}' AND CAST(year AS INTEGER) = {year}
-        GROUP BY crop
-        ORDER BY total_production DESC
-        LIMIT {top_m};
-        """
-        result = con.execute(query).df()
-        con.close()
+        _check_cache_version()
+        result = _top_crops(_cache_version, _normalize(state), year, top_m)
         
-        if result.empty:
+        if result is None:
             return f"No production data found for {state} in {year}."
             
-        return result.to_json(orient="records")
+        return result
     except Exception as e:
         return f"An error occurred while running the database query: {e}. Check state name spelling or data availability."
 @tool
@@ -52,26 +300,8 @@ def get_average_annual_rainfall(subdivision: str, start_year: int, end_year: int
     """
     print(f"Tool called: get_average_annual_rainfall(subdivision={subdivision}, start_year={start_year}, end_year={end_year})")
     try:
-        con = duckdb.connect(database=DB_FILE, read_only=True)
-        query = f"""
-        WITH YearlyTotals AS (
-            SELECT 
-                year, 
-                SUM(rainfall_mm) AS total_annual_rainfall,
-                ANY_VALUE(source_url) AS source_url
-            FROM climate_rainfall
-            WHERE subdivision ILIKE '{subdivision}' 
-              AND year BETWEEN {start_year} AND {end_year}
-            GROUP BY year
-        )
-        SELECT 
-            AVG(total_annual_rainfall) AS average_annual_rainfall,
-            ANY_VALUE(source_url) AS source_url
-        FROM YearlyTotals;
-        """
-        result = con.execute(query).df()
-        con.close()
-        return result.to_json(orient="records")
+        _check_cache_version()
+        return _average_rainfall(_cache_version, _normalize(subdivision), start_year, end_year)
     except Exception as e:
         return f"Error executing query: {e}"
 
@@ -79,58 +309,35 @@ def get_average_annual_rainfall(subdivision: str, start_year: int, end_year: int
 def correlate_crop_and_climate(
     crop_name: str, 
     state: str, 
-    subdivision: str, 
     start_year: int, 
     end_year: int
 ) -> str:
     """
     Analyzes the production trend of a specific crop in a state and correlates 
-    it with the annual rainfall trend in the corresponding climate subdivision 
-    over the same period.
+    it with the annual rainfall trend over the same period. The state's climate 
+    subdivisions are resolved automatically and their rainfall is averaged.
     """
-    print(f"Tool called: correlate_crop_and_climate(crop={crop_name}, state={state}, subdivision={subdivision}, ...)")
+    print(f"Tool called: correlate_crop_and_climate(crop={crop_name}, state={state}, ...)")
     try:
-        con = duckdb.connect(database=DB_FILE, read_only=True)
-        
-        crop_query = f"""
-        SELECT 
-            year, 
-            SUM(production_tonnes) AS total_production,
-            ANY_VALUE(source_url) AS source_url
-        FROM agriculture_production
-        WHERE state ILIKE '{state}' 
-          AND crop ILIKE '{crop_name}'
-          AND year BETWEEN {start_year} AND {end_year}
-        GROUP BY year
-        ORDER BY year;
-        """
-        crop_df = con.execute(crop_query).df()
-        
-        climate_query = f"""
-        SELECT 
-            year, 
-            SUM(rainfall_mm) AS total_annual_rainfall,
-            ANY_VALUE(source_url) AS source_url
-        FROM climate_rainfall
-        WHERE subdivision ILIKE '{subdivision}' 
-          AND year BETWEEN {start_year} AND {end_year}
-        GROUP BY year
-        ORDER BY year;
-        """
-        climate_df = con.execute(climate_query).df()
-        
-        con.close()
-        
-        correlation_data = {
-            "crop_production_trend": crop_df.to_dict(orient="records"),
-            "rainfall_trend": climate_df.to_dict(orient="records")
-        }
-        return json.dumps(correlation_data, indent=2)
+        _check_cache_version()
+        return _crop_climate_trends(
+            _cache_version,
+            _normalize(crop_name),
+            _normalize(state),
+            start_year,
+            end_year
+        )
         
     except Exception as e:
         return f"Error executing query: {e}"
 
 
+@functools.lru_cache(maxsize=1)
+def get_llm():
+    """Returns the shared chat model used by the agent."""
+    return ChatOpenAI(model="gpt-4o", temperature=0)
+
+
 def create_agent_executor():
     """Creates the LangChain agent and executor."""
     
@@ -140,7 +347,7 @@ def create_agent_executor():
         correlate_crop_and_climate
     ]
     
-    llm = ChatOpenAI(model="gpt-4o", temperature=0)
+    llm = get_llm()
     
     prompt_template = """
     You are Project Samarth, a specialized policy and agriculture assistant.
@@ -148,12 +355,12 @@ def create_agent_executor():
     Indian government sources.
     
     - You MUST use your tools to find data. Do not make up answers.
-    - The agriculture data has state names. The climate data has 
-      'subdivision' names. You must map them correctly. For example, 
-      the 'Punjab' state is in the 'Punjab' subdivision. 'Maharashtra' 
-      is complex and maps to multiple subdivisions like 'Vidarbha' or 
-      'Marathwada'. Use your best judgment or ask the user for clarification 
-      if a state maps to many subdivisions.
+    - To correlate a crop with rainfall, pass the state name; the tool 
+      resolves the state's climate subdivisions itself.
+    - The average rainfall tool takes an IMD meteorological subdivision, 
+      not a state. Some states span several subdivisions (e.g. Maharashtra 
+      covers Konkan & Goa, Madhya Maharashtra, Marathwada and Vidarbha); 
+      query each relevant subdivision or ask the user which one they mean.
     - When you get results from a tool, the data will be in JSON format.
     - Synthesize all the JSON data into a single, coherent, easy-to-read 
       answer for the user.
@@ -179,6 +386,95 @@ def create_agent_executor():
     
     return agent_executor
 
+def _response_cache_keys(user_input, chat_history, version):
+    """
+    Returns the exact and normalized cache keys for a question in context. 
+    The data version is part of the key, so an answer from a run that spanned 
+    an ETL reload is never served for the new data.
+    """
+    history_key = hash(tuple(chat_history[-2:]))
+    exact = user_input.strip().lower()
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", exact).split())
+    return (exact, history_key, version), (normalized, history_key, version)
+
+
+def _get_cached_response(keys):
+    with _response_cache_lock:
+        for key in keys:
+            if key in _response_cache:
+                _response_cache.move_to_end(key)
+                return _response_cache[key]
+    return None
+
+
+def _cache_response(keys, output):
+    with _response_cache_lock:
+        for key in keys:
+            _response_cache[key] = output
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+async def answer_question(agent_executor, user_input, chat_history):
+    """
+    Answers a question with the agent, reusing a previous answer when the 
+    same (or trivially rephrased) question was asked after the same turn.
+    """
+    # The version check can block on in-flight cursors; keep it off the shared loop.
+    await asyncio.to_thread(_check_cache_version)
+    keys = _response_cache_keys(user_input, chat_history, _cache_version)
+    cached = _get_cached_response(keys)
+    if cached is not None:
+        return cached
+    
+    result = await agent_executor.ainvoke({
+        "input": user_input,
+        "chat_history": chat_history
+    })
+    output = result['output']
+    
+    _cache_response(keys, output)
+    return output
+
+
+async def stream_answer(agent_executor, user_input, chat_history):
+    """
+    Like answer_question, but yields the answer text so far as the LLM 
+    writes it, so the UI can render it before the agent run finishes. Text 
+    from turns that end up calling tools is discarded when the tool starts, 
+    and the last value yielded is always the agent's final output.
+    """
+    # The version check can block on in-flight cursors; keep it off the shared loop.
+    await asyncio.to_thread(_check_cache_version)
+    keys = _response_cache_keys(user_input, chat_history, _cache_version)
+    cached = _get_cached_response(keys)
+    if cached is not None:
+        yield cached
+        return
+    
+    text = ""
+    output = None
+    async for event in agent_executor.astream_events(
+        {"input": user_input, "chat_history": chat_history},
+        version="v2"
+    ):
+        if event["event"] == "on_chat_model_stream":
+            chunk = event["data"]["chunk"]
+            if chunk.content and not chunk.tool_call_chunks:
+                text += chunk.content
+                yield text
+        elif event["event"] == "on_tool_start":
+            if text:
+                text = ""
+                yield text
+        elif event["event"] == "on_chain_end" and not event["parent_ids"]:
+            output = event["data"]["output"]["output"]
+    
+    if output is not None:
+        _cache_response(keys, output)
+        yield output
+
+
 if __name__ == "__main__":
     print("Testing agent setup...")
     agent_executor = create_agent_executor()
@@ -192,12 +488,9 @@ if __name__ == "__main__":
         if user_input.lower() in ['exit', 'quit']:
             break
             
-        result = agent_executor.invoke({
-            "input": user_input,
-            "chat_history": chat_history
-        })
+        output = run_async(answer_question(agent_executor, user_input, chat_history))
         
-        print(f"Samarth: {result['output']}")
+        print(f"Samarth: {output}")
         
         chat_history.append(("human", user_input))
-        chat_history.append(("ai", result['output']))
\ No newline at end of file
+        chat_history.append(("ai", output))
\ No newline at end of file
@@ -1,5 +1,5 @@
 import streamlit as st
-from agent import create_agent_executor
+from agent import create_agent_executor, iter_async, stream_answer, warm_connection
 
 st.set_page_config(
     page_title="Project Samarth",
@@ -10,9 +10,12 @@ st.set_page_config(
 st.title("🇮🇳 Project Samarth")
 st.caption("An intelligent Q&A system for India's agricultural and climate data.")
 
-if "agent_executor" not in st.session_state:
-    with st.spinner("Initializing AI agent..."):
-        st.session_state.agent_executor = create_agent_executor()
+@st.cache_resource(show_spinner="Initializing AI agent...")
+def get_executor():
+    warm_connection()
+    return create_agent_executor()
+
+agent_executor = get_executor()
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -33,13 +36,14 @@ if prompt:
     with st.chat_message("assistant"):
         with st.spinner("Analyzing data..."):
             
-            response = st.session_state.agent_executor.invoke({
-                "input": prompt,
-                "chat_history": st.session_state.chat_history
-            })
-            
-            ai_response = response['output']
-            st.markdown(ai_response)
+            placeholder = st.empty()
+            ai_response = ""
+            for ai_response in iter_async(stream_answer(
+                agent_executor,
+                prompt,
+                st.session_state.chat_history
+            )):
+                placeholder.markdown(ai_response)
     
     st.session_state.messages.append({"role": "assistant", "content": ai_response})
     
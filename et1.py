@@ -1,6 +1,13 @@
 import os
+import time
+import orjson
 import requests
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import duckdb
 from dotenv import load_dotenv
 
@@ -10,6 +17,11 @@ if not API_KEY:
     raise ValueError("DATA_GOV_API_KEY not found in .env file")
 
 DB_FILE = 'samarth.db'
+CACHE_VERSION_FILE = 'CACHE_VERSION'
+
+BASE_URL = "https://api.data.gov.in/resource/"
+PAGE_SIZE = 5000
+MAX_FETCH_WORKERS = 8
 
 DATASETS = {
     "agriculture": {
@@ -24,132 +36,353 @@ DATASETS = {
     }
 }
 
+PARQUET_FILES = {
+    "agriculture_production": "agriculture_production.parquet",
+    "climate_rainfall": "climate_rainfall.parquet"
+}
+
+# Typed schemas for the base tables. Raw values are coerced with TRY_CAST on
+# load, and rows where a required column fails to parse are dropped. Rows are
+# stored sorted on the tools' filter keys so DuckDB's zonemaps can skip row groups.
+# Each text key also gets a lowercase *_norm copy so lookups can use plain equality.
+TABLE_SCHEMAS = {
+    "agriculture_production": {
+        "columns": {
+            "state": "VARCHAR",
+            "district": "VARCHAR",
+            "crop": "VARCHAR",
+            "year": "INTEGER",
+            "season": "VARCHAR",
+            "area_hectare": "DOUBLE",
+            "production_tonnes": "DOUBLE",
+            "source_url": "VARCHAR"
+        },
+        "normalized": ["state", "crop"],
+        "required": ["year", "production_tonnes"],
+        "order_by": ["state_norm", "year"]
+    },
+    "climate_rainfall": {
+        "columns": {
+            "subdivision": "VARCHAR",
+            "year": "INTEGER",
+            "month": "VARCHAR",
+            "rainfall_mm": "DOUBLE",
+            "source_url": "VARCHAR"
+        },
+        "normalized": ["subdivision"],
+        "required": ["year", "rainfall_mm"],
+        "order_by": ["subdivision_norm", "year"]
+    }
+}
+
+ROLLUPS = {
+    "agri_state_year_crop": """
+        SELECT
+            state,
+            state_norm,
+            year,
+            crop,
+            crop_norm,
+            SUM(production_tonnes) AS total_production,
+            ANY_VALUE(source_url) AS source_url
+        FROM agriculture_production
+        GROUP BY 1, 2, 3, 4, 5
+        ORDER BY state_norm, year
+    """,
+    "climate_subdivision_year": """
+        SELECT
+            subdivision,
+            subdivision_norm,
+            year,
+            SUM(rainfall_mm) AS total_annual_rainfall,
+            ANY_VALUE(source_url) AS source_url
+        FROM climate_rainfall
+        GROUP BY 1, 2, 3
+        ORDER BY subdivision_norm, year
+    """
+}
+
+# Normalized agriculture state names -> the IMD rainfall subdivisions covering
+# them. Subdivisions are weighted equally within a state; 'matathwada' is the
+# spelling used by the source rainfall dataset.
+STATE_SUBDIVISIONS = {
+    "andaman and nicobar islands": ["andaman & nicobar islands"],
+    "andhra pradesh": ["coastal andhra pradesh", "rayalseema"],
+    "arunachal pradesh": ["arunachal pradesh"],
+    "assam": ["assam & meghalaya"],
+    "bihar": ["bihar"],
+    "chandigarh": ["haryana delhi & chandigarh"],
+    "chhattisgarh": ["chhattisgarh"],
+    "dadra and nagar haveli": ["gujarat region"],
+    "goa": ["konkan & goa"],
+    "gujarat": ["gujarat region", "saurashtra & kutch"],
+    "haryana": ["haryana delhi & chandigarh"],
+    "himachal pradesh": ["himachal pradesh"],
+    "jammu and kashmir": ["jammu & kashmir"],
+    "jharkhand": ["jharkhand"],
+    "karnataka": ["coastal karnataka", "north interior karnataka", "south interior karnataka"],
+    "kerala": ["kerala"],
+    "madhya pradesh": ["west madhya pradesh", "east madhya pradesh"],
+    "maharashtra": ["konkan & goa", "madhya maharashtra", "marathwada", "matathwada", "vidarbha"],
+    "manipur": ["naga mani mizo tripura"],
+    "meghalaya": ["assam & meghalaya"],
+    "mizoram": ["naga mani mizo tripura"],
+    "nagaland": ["naga mani mizo tripura"],
+    "odisha": ["orissa"],
+    "puducherry": ["tamil nadu"],
+    "punjab": ["punjab"],
+    "rajasthan": ["west rajasthan", "east rajasthan"],
+    "sikkim": ["sub himalayan west bengal & sikkim"],
+    "tamil nadu": ["tamil nadu"],
+    "telangana": ["telangana"],
+    "tripura": ["naga mani mizo tripura"],
+    "uttar pradesh": ["east uttar pradesh", "west uttar pradesh"],
+    "uttarakhand": ["uttarakhand"],
+    "west bengal": ["gangetic west bengal", "sub himalayan west bengal & sikkim"]
+}
+
+# Alternate spellings of subdivision names, as (common spelling, spelling in the
+# source rainfall dataset) pairs. Both directions are loaded so a lookup works
+# whichever spelling the data actually uses.
+SUBDIVISION_ALIASES = [
+    ("marathwada", "matathwada")
+]
+
+def fetch_page(session, resource_id, offset, limit):
+    """Fetches a single page of records from the data.gov.in API."""
+    response = session.get(
+        f"{BASE_URL}{resource_id}",
+        params={"api-key": API_KEY, "format": "json", "offset": offset, "limit": limit},
+        timeout=60
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
 def fetch_data(resource_id, limit):
-    """Fetches data from the data.gov.in API."""
-    base_url = "https://api.data.gov.in/resource/"
-    url = f"{base_url}{resource_id}?api-key={API_KEY}&format=json&limit={limit}"
-    
+    """Fetches up to `limit` records from the data.gov.in API, pulling pages concurrently."""
     print(f"Fetching data from {resource_id}...")
     try:
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        
-        if 'records' not in data:
-            print(f"Error: 'records' key not in response. Response: {data}")
-            return None
+        with requests.Session() as session:
+            session.mount("https://", HTTPAdapter(pool_maxsize=MAX_FETCH_WORKERS))
+            
+            data = fetch_page(session, resource_id, 0, min(PAGE_SIZE, limit))
+            if 'records' not in data:
+                print(f"Error: 'records' key not in response. Response: {data}")
+                return None
+            
+            records = list(data['records'])
+            total = min(int(data.get('total') or len(records)), limit)
+            # The API may cap page sizes below PAGE_SIZE, so step by what it actually returned.
+            stride = len(records)
+            offsets = range(stride, total, stride) if stride else []
             
-        print(f"Successfully fetched {len(data['records'])} records.")
-        return data['records']
+            executor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS)
+            try:
+                futures = [
+                    executor.submit(fetch_page, session, resource_id, offset, min(stride, total - offset))
+                    for offset in offsets
+                ]
+                for future in futures:
+                    page = future.result()
+                    if 'records' not in page:
+                        print(f"Error: 'records' key not in response. Response: {page}")
+                        return None
+                    records.extend(page['records'])
+            finally:
+                # On failure, drop the pages still queued instead of downloading them.
+                executor.shutdown(cancel_futures=True)
+            
+        print(f"Successfully fetched {len(records)} records.")
+        return records
         
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         print(f"Error fetching data: {e}")
         return None
 
+def clean_text(array):
+    """Trims and title-cases an Arrow string array in a single vectorized pass."""
+    return pc.utf8_title(pc.utf8_trim_whitespace(array))
+
+def _to_str(value):
+    """Renders a raw API value as text, keeping missing values as None."""
+    return None if value is None else str(value)
+
 def transform_agri_data(records, source_url):
-    """Transforms raw agriculture data into a clean DataFrame."""
+    """Transforms raw agriculture data into a clean Arrow table."""
     print("Transforming agriculture data...")
-    df = pd.DataFrame(records)
-
-    df.rename(columns={
+    columns = {
         "state_name": "state",
         "district_name": "district",
+        "crop": "crop",
         "crop_year": "year",
         "season": "season",
-        "crop": "crop",
         "area_": "area_hectare",
         "production_": "production_tonnes"
-    }, inplace=True)
-    
-    df = df[['state', 'district', 'crop', 'year', 'season', 'area_hectare', 'production_tonnes']]
-    
-    df['source_url'] = source_url
+    }
     
-    df['year'] = pd.to_numeric(df['year'], errors='coerce')
-    df['production_tonnes'] = pd.to_numeric(df['production_tonnes'], errors='coerce')
+    # Every raw column is kept as text; DuckDB's TRY_CAST types the numerics on 
+    # load, so records with missing keys or mixed value types can't break this.
+    table = pa.table({
+        name: pa.array(
+            [_to_str(r.get(raw)) for r in records],
+            type=pa.string()
+        )
+        for raw, name in columns.items()
+    })
     
-    df.dropna(subset=['year', 'production_tonnes', 'state', 'district', 'crop'], inplace=True)
+    table = table.append_column("source_url", pa.array([source_url] * table.num_rows, type=pa.string()))
     
-    df['year'] = df['year'].astype(int) 
+    table = table.filter(
+        pc.field("state").is_valid() & pc.field("district").is_valid() & pc.field("crop").is_valid()
+    )
     
-    df['state'] = df['state'].str.strip().str.title()
-    df['district'] = df['district'].str.strip().str.title()
-    df['crop'] = df['crop'].str.strip().str.title()
+    for name in ['state', 'district', 'crop']:
+        i = table.schema.get_field_index(name)
+        table = table.set_column(i, name, clean_text(table.column(name)))
     
-    print(f"Agriculture data transformed. {len(df)} clean records.")
-    return df
+    print(f"Agriculture data transformed. {table.num_rows} clean records.")
+    return table
+
+def _to_float(value):
+    """Parses a raw API value as a float, returning NaN when it isn't numeric."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
 
 def transform_climate_data(records, source_url):
-    """Transforms raw climate data into a clean, 'tidy' DataFrame."""
+    """Transforms raw climate data into a clean, 'tidy' Arrow table."""
     print("Transforming climate data...")
-    df = pd.DataFrame(records)
-    
-    df.rename(columns={
-        "subdivision": "subdivision", 
-        "year": "year"
-    }, inplace=True)
+    n = len(records)
     
     month_columns_raw = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
     
-    for col in month_columns_raw:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-    df_tidy = df.melt(
-        id_vars=["subdivision", "year"],
-        value_vars=month_columns_raw, 
-        var_name="month",
-        value_name="rainfall_mm"
-    )
+    years = np.fromiter((_to_float(r.get('year')) for r in records), dtype=float, count=n)
+    subdivisions = clean_text(pa.array(
+        [s if isinstance(s, str) else None for s in (r.get('subdivision') for r in records)],
+        type=pa.string()
+    ))
+    has_subdivision = subdivisions.is_valid().to_numpy(zero_copy_only=False)
     
-    df_tidy['source_url'] = source_url
+    # Wide -> long: one contiguous block of n values per month.
+    rainfall_mm = np.concatenate([
+        np.fromiter((_to_float(r.get(month)) for r in records), dtype=float, count=n)
+        for month in month_columns_raw
+    ])
+    year = np.tile(years, len(month_columns_raw))
+    record_index = np.tile(np.arange(n), len(month_columns_raw))
+    month = np.repeat(np.array(month_columns_raw), n)
     
-    df_tidy['year'] = pd.to_numeric(df_tidy['year'], errors='coerce')
-    df_tidy.dropna(subset=['year', 'rainfall_mm', 'subdivision'], inplace=True)
-    df_tidy['year'] = df_tidy['year'].astype(int) 
+    keep = ~np.isnan(year) & ~np.isnan(rainfall_mm) & np.tile(has_subdivision, len(month_columns_raw))
     
-    df_tidy['subdivision'] = df_tidy['subdivision'].str.strip().str.title()
+    table = pa.table({
+        "subdivision": subdivisions.take(record_index[keep]),
+        "year": year[keep].astype(int),
+        "month": month[keep],
+        "rainfall_mm": rainfall_mm[keep],
+        "source_url": pa.array([source_url] * int(keep.sum()), type=pa.string())
+    })
     
-    print(f"Climate data transformed. {len(df_tidy)} clean records.")
-    return df_tidy
+    print(f"Climate data transformed. {table.num_rows} clean records.")
+    return table
 
-def load_to_duckdb(dataframes, db_file):
-    """Loads a dictionary of DataFrames into DuckDB tables."""
-    con = duckdb.connect(database=db_file, read_only=False)
+def load_to_duckdb(parquet_files, db_file):
+    """
+    Loads a dictionary of Parquet files into DuckDB tables. The database is 
+    built in a temporary file and renamed into place, so a running agent 
+    holding a read-only connection to the old file doesn't block the reload.
+    """
+    build_file = f"{db_file}.tmp"
+    if os.path.exists(build_file):
+        os.remove(build_file)
+    con = duckdb.connect(database=build_file, read_only=False)
     
-    for table_name, df in dataframes.items():
+    for table_name, path in parquet_files.items():
         print(f"Loading data into table: {table_name}...")
-        con.register('temp_df', df)
-        con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM temp_df")
+        schema = TABLE_SCHEMAS[table_name]
+        columns = ", ".join(
+            [f"{name} {dtype}" for name, dtype in schema["columns"].items()]
+            + [f"{name}_norm VARCHAR" for name in schema["normalized"]]
+        )
+        casts = ", ".join(f"TRY_CAST({name} AS {dtype}) AS {name}" for name, dtype in schema["columns"].items())
+        norms = ", ".join(f"lower(trim({name})) AS {name}_norm" for name in schema["normalized"])
+        required = " AND ".join(f"{name} IS NOT NULL" for name in schema["required"])
+        
+        con.execute(f"CREATE OR REPLACE TABLE {table_name} ({columns})")
+        con.execute(f"""
+            INSERT INTO {table_name}
+            SELECT *, {norms} FROM (SELECT {casts} FROM read_parquet('{path}'))
+            WHERE {required}
+            ORDER BY {", ".join(schema["order_by"])}
+        """)
         print(f"Table '{table_name}' created successfully.")
+    
+    for table_name, query in ROLLUPS.items():
+        print(f"Building pre-aggregated table: {table_name}...")
+        con.execute(f"CREATE OR REPLACE TABLE {table_name} AS {query}")
+        print(f"Table '{table_name}' created successfully.")
+    
+    print("Loading state to subdivision mapping: state_subdivision_map...")
+    con.execute("""
+        CREATE OR REPLACE TABLE state_subdivision_map (
+            state_norm VARCHAR, subdivision_norm VARCHAR, weight DOUBLE
+        )
+    """)
+    con.executemany(
+        "INSERT INTO state_subdivision_map VALUES (?, ?, ?)",
+        [
+            (state, subdivision, 1.0)
+            for state, subdivisions in STATE_SUBDIVISIONS.items()
+            for subdivision in subdivisions
+        ]
+    )
+    print("Table 'state_subdivision_map' created successfully.")
+    
+    print("Loading subdivision aliases: subdivision_alias...")
+    con.execute("""
+        CREATE OR REPLACE TABLE subdivision_alias (
+            alias_norm VARCHAR, subdivision_norm VARCHAR
+        )
+    """)
+    con.executemany(
+        "INSERT INTO subdivision_alias VALUES (?, ?)",
+        SUBDIVISION_ALIASES + [(b, a) for a, b in SUBDIVISION_ALIASES]
+    )
+    print("Table 'subdivision_alias' created successfully.")
         
     print("\nTables in database:")
     print(con.execute("SHOW TABLES").fetchall())
     
     con.close()
+    os.replace(build_file, db_file)
+    
+    # Bumping the version tells running agents to reopen the database and drop 
+    # their cached results.
+    with open(CACHE_VERSION_FILE, 'w') as f:
+        f.write(str(time.time_ns()))
 
 
 if __name__ == "__main__":
     
-    agri_records = fetch_data(
-        DATASETS["agriculture"]["resource_id"], 
-        DATASETS["agriculture"]["limit"]
-    )
-    climate_records = fetch_data(
-        DATASETS["climate"]["resource_id"],
-        DATASETS["climate"]["limit"]
-    )
+    with ThreadPoolExecutor(max_workers=len(DATASETS)) as executor:
+        futures = {
+            name: executor.submit(fetch_data, dataset["resource_id"], dataset["limit"])
+            for name, dataset in DATASETS.items()
+        }
+        records = {name: future.result() for name, future in futures.items()}
+    
+    agri_records = records["agriculture"]
+    climate_records = records["climate"]
     
     if agri_records and climate_records:
         
-        df_agri = transform_agri_data(agri_records, DATASETS["agriculture"]["url"])
-        df_climate = transform_climate_data(climate_records, DATASETS["climate"]["url"])
+        agri_table = transform_agri_data(agri_records, DATASETS["agriculture"]["url"])
+        climate_table = transform_climate_data(climate_records, DATASETS["climate"]["url"])
+        
+        pq.write_table(agri_table, PARQUET_FILES["agriculture_production"])
+        pq.write_table(climate_table, PARQUET_FILES["climate_rainfall"])
         
-      
-        load_to_duckdb({
-            "agriculture_production": df_agri,
-            "climate_rainfall": df_climate
-        }, DB_FILE)
+        load_to_duckdb(PARQUET_FILES, DB_FILE)
         
         print(f"\n✅ ETL process complete. Database '{DB_FILE}' is ready.")
     else: